@@ -1,15 +1,21 @@
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError
+import functools
 import logging
+import os
 import psycopg2
 from psycopg2 import pool
+from psycopg2.extras import execute_batch
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 import time
 from datetime import datetime
 import threading
 from typing import Optional
 import random
-import queue
+import signal
+from collections import deque
 
 # ログ設定
 logging.basicConfig(
@@ -19,34 +25,68 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+@functools.lru_cache(maxsize=None)
+def _get_dsql_client(region):
+    """リージョンごとに1つのboto3 DSQLクライアントをプロセス内で共有する
+
+    boto3クライアントの生成はサービスモデルの読み込み等で高コストなため
+    モジュールレベルでキャッシュする。HTTP接続プールも広めに確保し、
+    並行するトークン取得がソケット待ちにならないようにする。
+    """
+    return boto3.session.Session().client(
+        'dsql',
+        region_name=region,
+        config=Config(
+            retries={'max_attempts': 3, 'mode': 'adaptive'},
+            tcp_keepalive=True,
+            max_pool_connections=50,
+        )
+    )
+
 class DSQLAuthenticator:
+    # トークンを期限切れ直前まで再利用するための安全マージン（秒）
+    TOKEN_SAFETY_MARGIN = 30
+
     def __init__(self, region='us-east-1'):
         self.region = region
-        self.dsql_client = None
-        
+        self._token_cache = {}
+        self._token_lock = threading.Lock()
+
     def _get_dsql_client(self):
-        if self.dsql_client is None:
-            try:
-                self.dsql_client = boto3.client('dsql', region_name=self.region)
-            except Exception as e:
-                logger.error(f"DSQLクライアントの作成に失敗しました: {e}")
-                raise
-        return self.dsql_client
+        try:
+            return _get_dsql_client(self.region)
+        except Exception as e:
+            logger.error(f"DSQLクライアントの作成に失敗しました: {e}")
+            raise
     
     def get_auth_token(self, cluster_identifier, expires):
+        cache_key = (cluster_identifier, expires)
+        with self._token_lock:
+            cached = self._token_cache.get(cache_key)
+            if cached:
+                token, expires_at = cached
+                # 期限切れ間際でなければキャッシュ済みトークンを再利用（SigV4署名を省略）
+                if time.monotonic() < expires_at - self.TOKEN_SAFETY_MARGIN:
+                    logger.debug("キャッシュ済みの認証トークンを再利用します")
+                    return token
+
         try:
             client = self._get_dsql_client()
-            
+
             token = client.generate_db_connect_admin_auth_token(
                 Hostname=cluster_identifier,
                 ExpiresIn=expires
             )
-            
+
             if not token:
                 raise ValueError("認証トークンの取得に失敗しました")
 
+            with self._token_lock:
+                self._token_cache[cache_key] = (token, time.monotonic() + expires)
+
             return token
-            
+
         except NoCredentialsError:
             logger.error("AWS認証情報が設定されていません")
             raise
@@ -69,16 +109,38 @@ class DSQLConnectionWrapper:
         """
         self.connection = connection
         self.created_at = datetime.now()
-        
+        self.last_used = time.monotonic()
+        self._probe_cursor = None
+        # この接続でPREPARE済みのステートメント名（接続と寿命を共にする）
+        self.prepared_statements = set()
+
     def is_healthy(self):
         try:
             if self.connection.closed:
                 logger.warning(f"接続の健全性:closed")
                 return False
-                
-            with self.connection.cursor() as cur:
-                cur.execute("SELECT 1")
-                cur.fetchone()
+
+            # 暗黙のBEGINで開いたままのトランザクションが残っていると
+            # autocommitの切り替えがProgrammingErrorになるため、先に巻き戻す
+            if self.connection.info.transaction_status != \
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                self.connection.rollback()
+
+            # プローブのためだけに暗黙のBEGIN/COMMIT（XID・スナップショットの
+            # 割り当て）が走らないよう、autocommitで実行する。
+            # DSQLはトランザクション制限が厳しい点にも効く（transaction_limit.py参照）
+            # プローブ用カーソルは初回に1つだけ作り、以降は使い回して
+            # カーソル生成のアロケーションを省く
+            if self._probe_cursor is None or self._probe_cursor.closed:
+                self._probe_cursor = self.connection.cursor()
+
+            prev_autocommit = self.connection.autocommit
+            try:
+                self.connection.autocommit = True
+                self._probe_cursor.execute("SELECT 1")
+                self._probe_cursor.fetchone()
+            finally:
+                self.connection.autocommit = prev_autocommit
             return True
         except Exception as e:
             logger.warning(f"接続健全性チェック失敗: {e}")
@@ -94,9 +156,15 @@ class DSQLConnectionWrapper:
 
 class DSQLCustomConnectionPool:
     """DSQL専用のカスタムコネクションプール"""
-    
-    def __init__(self, authenticator, cluster_id, endpoint, minconn=1, maxconn=20, 
-                 database='postgres', username='admin'):
+
+    # プール状態文字列をキャッシュする秒数
+    STATUS_CACHE_TTL = 1.0
+    # トークンの要求有効期間（秒）。このプールは接続を寿命で作り直さない
+    # ため、キャッシュが効く下限の900秒を使う
+    TOKEN_EXPIRES = 900
+
+    def __init__(self, authenticator, cluster_id, endpoint, minconn=1, maxconn=20,
+                 database='postgres', username='admin', idle_probe_threshold=60):
         self.authenticator = authenticator
         self.cluster_id = cluster_id
         self.endpoint = endpoint
@@ -104,89 +172,161 @@ class DSQLCustomConnectionPool:
         self.maxconn = maxconn
         self.database = database
         self.username = username
-        
-        self._pool = queue.Queue(maxsize=maxconn)
-        self._pool_lock = threading.Lock()
-        self._current_connections = 0
-        
+        # このアイドル秒数を超えた接続のみSELECT 1でプローブする
+        self.idle_probe_threshold = idle_probe_threshold
+        # 静的な接続パラメータは毎回kwargsから組み立てず事前に文字列化しておく
+        self._conninfo = (f"host={endpoint} dbname={database} "
+                          f"user={username} port=5432 sslmode=require")
+
+        # dequeの個々のappend/popleftはアトミックで、queue.Queueの
+        # 条件変数まわりのオーバーヘッドがない
+        self._pool = deque()
+        # 返却時のmaxconn判定のみ短いロックで保護する
+        self._return_lock = threading.Lock()
+        # 接続数の上限管理はセマフォに任せる（許可1つ＝作成枠1つ）
+        self._capacity = threading.BoundedSemaphore(maxconn)
+        # レポート用の総接続数（セマフォの内部値には依存しない）
+        self._total_connections = 0
+        self._count_lock = threading.Lock()
+        self._status_cache = None
+        self._status_cached_at = 0.0
+        self._status_lock = threading.Lock()
+
         self._init_pool()
         
     def _init_pool(self):
-        """プールを初期接続で満たす"""
+        """プールを初期接続で満たす
+
+        接続作成はI/Oバウンド（トークン取得＋TLSハンドシェイク）なので
+        並列に実行し、ウォームアップ時間をminconn×RTTからRTT1回分に抑える。
+        """
         logger.info(f"コネクションプールを初期化中 (minconn={self.minconn})")
-        for i in range(self.minconn):
-            try:
-                conn_wrapper = self._create_connection()
-                self._pool.put(conn_wrapper, block=False)
-                self._current_connections += 1
-            except Exception as e:
-                logger.error(f"初期接続作成エラー {i+1}/{self.minconn}: {e}")
+        if self.minconn <= 0:
+            return
+        with ThreadPoolExecutor(max_workers=self.minconn) as executor:
+            futures = [executor.submit(self._create_connection)
+                       for _ in range(self.minconn)]
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    conn_wrapper = future.result()
+                    if self._acquire_slot():
+                        self._pool.append(conn_wrapper)
+                    else:
+                        conn_wrapper.close()
+                except Exception as e:
+                    logger.error(f"初期接続作成エラー {i+1}/{self.minconn}: {e}")
                 
     def _create_connection(self):
         """新しい接続を作成してラッパーで包む"""
-        token = self.authenticator.get_auth_token(self.cluster_id, 5)
-        
-        connection = psycopg2.connect(
-            host=self.endpoint,
-            database=self.database,
-            user=self.username,
-            password=token,
-            port=5432,
-            sslmode='require'
-        )
+        token = self.authenticator.get_auth_token(self.cluster_id, self.TOKEN_EXPIRES)
         
+        connection = psycopg2.connect(self._conninfo, password=token)
+
         logger.debug("新しいDSQLコネクションを作成しました")
         return DSQLConnectionWrapper(connection)
+
+    def _acquire_slot(self):
+        """作成枠を1つ予約する（成功時はレポート用カウンタも加算）"""
+        if not self._capacity.acquire(blocking=False):
+            return False
+        with self._count_lock:
+            self._total_connections += 1
+        return True
+
+    def _release_slot(self):
+        """作成枠を1つ返す（レポート用カウンタも減算）"""
+        with self._count_lock:
+            self._total_connections -= 1
+        self._capacity.release()
     
     def get_connection(self):
-        """プールから健全な接続を取得、必要に応じて新規作成"""
-        with self._pool_lock:
-            while True:
+        """プールから健全な接続を取得、必要に応じて新規作成
+
+        deque.popleft()はアトミックなので、外側のロックは持たない。
+        ネットワークI/O（ヘルスチェック・接続作成）をロック外で行うことで
+        ワーカースレッドが直列化されるのを防ぐ。
+        """
+        while True:
+            try:
+                conn_wrapper = self._pool.popleft()
+            except IndexError:
+                # プールが空。作成枠の予約はセマフォが原子的に行う
+                if not self._acquire_slot():
+                    logger.warning("接続上限に達しました。少し待ってから再試行してください")
+                    raise Exception("コネクションプール上限に達しました")
+
+                logger.debug("プールが空、新しい接続を作成")
                 try:
-                    conn_wrapper = self._pool.get(block=False)
-                    
-                    if conn_wrapper.is_healthy():
-                        connection_id = f"conn_{id(conn_wrapper.connection)}"
-                        logger.info(f"プールから健全な接続を取得: {connection_id}")
-                        return conn_wrapper
-                    else:
-                        logger.warning("不健全な接続を検出、破棄して新しい接続を作成")
-                        conn_wrapper.close()
-                        new_conn_wrapper = self._create_connection()
-                        connection_id = f"conn_{id(new_conn_wrapper.connection)}"
-                        logger.info(f"新しい接続を作成して返却: {connection_id}")
-                        return new_conn_wrapper
-                        
-                except queue.Empty:
-                    if self._current_connections < self.maxconn:
-                        logger.info("プールが空、新しい接続を作成")
-                        conn_wrapper = self._create_connection()
-                        self._current_connections += 1
-                        connection_id = f"conn_{id(conn_wrapper.connection)}"
-                        logger.info(f"プール空で新しい接続を返却: {connection_id}")
-                        return conn_wrapper
-                    else:
-                        logger.warning("接続上限に達しました。少し待ってから再試行してください")
-                        raise Exception("コネクションプール上限に達しました")
+                    conn_wrapper = self._create_connection()
+                except Exception:
+                    self._release_slot()
+                    raise
+                logger.debug("プール空で新しい接続を返却: conn_%s",
+                             id(conn_wrapper.connection))
+                return conn_wrapper
+
+            # アイドル時間が短ければローカルチェックのみで返す
+            # （SELECT 1のラウンドトリップを省略し、実際に死んでいれば
+            # 初回利用時にpsycopg2がエラーを返す）
+            idle_time = time.monotonic() - conn_wrapper.last_used
+            if not conn_wrapper.connection.closed and \
+                    idle_time <= self.idle_probe_threshold:
+                healthy = True
+            else:
+                healthy = conn_wrapper.is_healthy()
+
+            if healthy:
+                # %s形式はDEBUG無効時にフォーマット処理ごとスキップされる
+                logger.debug("プールから健全な接続を取得: conn_%s",
+                             id(conn_wrapper.connection))
+                return conn_wrapper
+            else:
+                logger.warning("不健全な接続を検出、破棄して新しい接続を作成")
+                conn_wrapper.close()
+                try:
+                    new_conn_wrapper = self._create_connection()
+                except Exception:
+                    # 破棄した接続が持っていた作成枠を返さないと
+                    # プール容量が恒久的に減ってしまう
+                    self._release_slot()
+                    raise
+                logger.debug("新しい接続を作成して返却: conn_%s",
+                             id(new_conn_wrapper.connection))
+                return new_conn_wrapper
     
     def put_connection(self, conn_wrapper):
         """接続をプールに戻す"""
+        # ワーカーのクエリが開いた暗黙のトランザクションを閉じてから返却する
+        # （開いたまま戻すと次回チェックアウトのプローブが失敗する）
         try:
-            self._pool.put(conn_wrapper, block=False)
-            logger.debug("接続をプールに戻しました")
-        except queue.Full:
-            logger.warning("プールが満杯、接続を破棄")
+            if not conn_wrapper.connection.closed:
+                conn_wrapper.connection.rollback()
+        except Exception as e:
+            logger.warning(f"返却時のロールバック失敗: {e}")
             conn_wrapper.close()
-            with self._pool_lock:
-                self._current_connections -= 1
+            self._release_slot()
+            return
+        conn_wrapper.last_used = time.monotonic()
+        with self._return_lock:
+            if len(self._pool) < self.maxconn:
+                self._pool.append(conn_wrapper)
+                logger.debug("接続をプールに戻しました")
+                return
+        logger.warning("プールが満杯、接続を破棄")
+        conn_wrapper.close()
+        self._release_slot()
     
     @contextmanager
     def get_db_connection(self):
-        """コンテキストマネージャーとして接続を提供"""
+        """コンテキストマネージャーとして接続ラッパーを提供
+
+        生の接続は`.connection`で参照する。PREPARE済みフラグ等の
+        接続に紐づく状態はラッパー側に持たせる。
+        """
         conn_wrapper = None
         try:
             conn_wrapper = self.get_connection()
-            yield conn_wrapper.connection
+            yield conn_wrapper
         except Exception as e:
             logger.error(f"接続取得エラー: {e}")
             raise
@@ -195,39 +335,96 @@ class DSQLCustomConnectionPool:
                 self.put_connection(conn_wrapper)
     
     def get_pool_status(self):
-        """プールの状態を取得"""
-        try:
-            available_connections = self._pool.qsize()
-            used_connections = self._current_connections - available_connections
-            return f"総接続数:{self._current_connections}, 利用可能:{available_connections}, 使用中:{used_connections}"
-        except Exception as e:
-            return f"プール状態取得エラー: {e}"
+        """プールの状態を取得（TTL内は全スレッドにキャッシュ済み文字列を返す）"""
+        now = time.monotonic()
+        with self._status_lock:
+            if self._status_cache is not None and \
+                    now - self._status_cached_at < self.STATUS_CACHE_TTL:
+                return self._status_cache
+            try:
+                with self._count_lock:
+                    total_connections = self._total_connections
+                available_connections = len(self._pool)
+                used_connections = total_connections - available_connections
+                status = f"総接続数:{total_connections}, 利用可能:{available_connections}, 使用中:{used_connections}"
+            except Exception as e:
+                return f"プール状態取得エラー: {e}"
+            self._status_cache = status
+            self._status_cached_at = now
+            return status
     
     def close_all(self):
         """すべての接続を閉じる"""
         logger.info("全接続を閉じます")
-        while not self._pool.empty():
+        while True:
             try:
-                conn_wrapper = self._pool.get(block=False)
-                conn_wrapper.close()
-            except queue.Empty:
+                conn_wrapper = self._pool.popleft()
+            except IndexError:
                 break
-        with self._pool_lock:
-            self._current_connections = 0
+            conn_wrapper.close()
+            self._release_slot()
+
+# プロセス全体で共有するデフォルトプール
+# （Lambdaのウォームスタート間で接続を使い回すための置き場）
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def _handle_sigterm(signum, frame):
+    """Lambda拡張のSIGTERM（環境シャットダウン）で接続を後始末する
+
+    ハンドラはメインスレッドで実行されるため、get_default_pool()が
+    保持しているかもしれない非再入の_default_pool_lockは取らない
+    （構築中にSIGTERMが来るとデッドロックするため、参照の差し替えだけで済ませる）。
+    後始末の後はデフォルトの動作に戻してSIGTERMを再送し、
+    stop_flag.wait()で待機中のプロセスも確実に終了させる。
+    """
+    global _default_pool
+    pool_to_close = _default_pool
+    _default_pool = None
+    if pool_to_close is not None:
+        pool_to_close.close_all()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def get_default_pool(authenticator=None, cluster_id=None, endpoint=None, **kwargs):
+    """モジュールレベルの共有プールを遅延生成して返す
+
+    Lambdaハンドラはリクエストごとにプールを作らず、この関数経由で
+    1プロセス1プールを再利用することで接続をウォームに保つ。
+    生成はダブルチェックロックで1回だけ行われる。
+    """
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                if authenticator is None or cluster_id is None or endpoint is None:
+                    raise ValueError(
+                        "初回呼び出しにはauthenticator・cluster_id・endpointが必要です")
+                _default_pool = DSQLCustomConnectionPool(
+                    authenticator=authenticator,
+                    cluster_id=cluster_id,
+                    endpoint=endpoint,
+                    **kwargs
+                )
+                try:
+                    signal.signal(signal.SIGTERM, _handle_sigterm)
+                except ValueError:
+                    # メインスレッド以外からはシグナルハンドラを登録できない
+                    logger.debug("SIGTERMハンドラの登録をスキップしました")
+    return _default_pool
+
 
 class DSQLConnector:
     @contextmanager
     def connect(self, cluster_identifier, token, database='postgres', username='admin'):
         connection = None
         try:
-            connection = psycopg2.connect(
-                host=cluster_identifier,
-                database=database,
-                user=username,
-                password=token,
-                port=5432,
-                sslmode='require'
-            )
+            # 静的部分を1つのconninfo文字列として渡す
+            conninfo = (f"host={cluster_identifier} dbname={database} "
+                        f"user={username} port=5432 sslmode=require")
+            connection = psycopg2.connect(conninfo, password=token)
             yield connection
             
         except psycopg2.Error as e:
@@ -237,6 +434,15 @@ class DSQLConnector:
             if connection:
                 connection.close()
 
+    def execute_batched(self, connection, query, params_list, page_size=100):
+        """複数の小さなクエリを1回の往復にまとめて実行する
+
+        psycopg2にはlibpqのパイプラインAPIがないため、execute_batchで
+        複数文を連結して送信し、N往復を約1往復に減らす。
+        """
+        with connection.cursor() as cur:
+            execute_batch(cur, query, params_list, page_size=page_size)
+
 
 def test_connection_pool():
     CLUSTER_ID = "g4abult6r6rrzachxrubfgunia"
@@ -258,9 +464,16 @@ def test_connection_pool():
         def worker_thread(thread_id):
             while not stop_flag.is_set():
                 try:
-                    with pool_manager.get_db_connection() as conn:
-                        with conn.cursor() as cur:
-                            cur.execute("SELECT CURRENT_TIMESTAMP, 'thread_' || %s;", (thread_id,))
+                    with pool_manager.get_db_connection() as conn_wrapper:
+                        with conn_wrapper.connection.cursor() as cur:
+                            # 初回のみPREPAREし、以降はEXECUTEで
+                            # サーバ側のパース／プラン処理を省略する
+                            if 'worker_stmt' not in conn_wrapper.prepared_statements:
+                                cur.execute(
+                                    "PREPARE worker_stmt(int) AS "
+                                    "SELECT CURRENT_TIMESTAMP, 'thread_' || $1;")
+                                conn_wrapper.prepared_statements.add('worker_stmt')
+                            cur.execute("EXECUTE worker_stmt(%s);", (thread_id,))
                             result = cur.fetchone()
                             timestamp, thread_msg = result
                             logger.info(f"✓ スレッド{thread_id}: {thread_msg} at {timestamp}")
@@ -281,9 +494,9 @@ def test_connection_pool():
             thread.start()
                 
         try:
-            # メインスレッドを維持
-            while True:
-                time.sleep(1)
+            # メインスレッドは停止フラグがセットされるまでOSレベルで待機する
+            # （1秒ごとの起床によるコンテキストスイッチをなくす）
+            stop_flag.wait()
         except KeyboardInterrupt:
             stop_flag.set()
                     
@@ -1,5 +1,7 @@
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError
+import functools
 import logging
 import psycopg2
 import threading
@@ -21,34 +23,68 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+@functools.lru_cache(maxsize=None)
+def _get_dsql_client(region):
+    """リージョンごとに1つのboto3 DSQLクライアントをプロセス内で共有する
+
+    boto3クライアントの生成はサービスモデルの読み込み等で高コストなため
+    モジュールレベルでキャッシュする。HTTP接続プールも広めに確保し、
+    並行するトークン取得がソケット待ちにならないようにする。
+    """
+    return boto3.session.Session().client(
+        'dsql',
+        region_name=region,
+        config=Config(
+            retries={'max_attempts': 3, 'mode': 'adaptive'},
+            tcp_keepalive=True,
+            max_pool_connections=50,
+        )
+    )
+
 class DSQLAuthenticator:
+    # トークンを期限切れ直前まで再利用するための安全マージン（秒）
+    TOKEN_SAFETY_MARGIN = 30
+
     def __init__(self, region='us-east-1'):
         self.region = region
-        self.dsql_client = None
-        
+        self._token_cache = {}
+        self._token_lock = threading.Lock()
+
     def _get_dsql_client(self):
-        if self.dsql_client is None:
-            try:
-                self.dsql_client = boto3.client('dsql', region_name=self.region)
-            except Exception as e:
-                logger.error(f"DSQLクライアントの作成に失敗しました: {e}")
-                raise
-        return self.dsql_client
+        try:
+            return _get_dsql_client(self.region)
+        except Exception as e:
+            logger.error(f"DSQLクライアントの作成に失敗しました: {e}")
+            raise
     
     def get_auth_token(self, cluster_identifier, expires):
+        cache_key = (cluster_identifier, expires)
+        with self._token_lock:
+            cached = self._token_cache.get(cache_key)
+            if cached:
+                token, expires_at = cached
+                # 期限切れ間際でなければキャッシュ済みトークンを再利用（SigV4署名を省略）
+                if time.monotonic() < expires_at - self.TOKEN_SAFETY_MARGIN:
+                    logger.debug("キャッシュ済みの認証トークンを再利用します")
+                    return token
+
         try:
             client = self._get_dsql_client()
-            
+
             token = client.generate_db_connect_admin_auth_token(
                 Hostname=cluster_identifier,
                 ExpiresIn=expires
             )
-            
+
             if not token:
                 raise ValueError("認証トークンの取得に失敗しました")
 
+            with self._token_lock:
+                self._token_cache[cache_key] = (token, time.monotonic() + expires)
+
             return token
-            
+
         except NoCredentialsError:
             logger.error("AWS認証情報が設定されていません")
             raise
@@ -63,10 +99,10 @@ class DSQLAuthenticator:
 
 class DSQLSQLAlchemyPool:
     """SQLAlchemyを使用したDSQLコネクションプール"""
-    
-    def __init__(self, authenticator, cluster_id, endpoint, database='postgres', 
+
+    def __init__(self, authenticator, cluster_id, endpoint, database='postgres',
                  username='admin', pool_size=3, max_overflow=2, pool_timeout=30,
-                 pool_recycle=3600):
+                 pool_recycle=300):
         self.authenticator = authenticator
         self.cluster_id = cluster_id
         self.endpoint = endpoint
@@ -76,10 +112,60 @@ class DSQLSQLAlchemyPool:
         self.max_overflow = max_overflow
         self.pool_timeout = pool_timeout
         self.pool_recycle = pool_recycle
-        
+        # トークンの有効期間はpool_recycleに合わせる（再接続1サイクルに
+        # つき署名1回で済むよう、余裕60秒・下限900秒）
+        self.token_expires = max(pool_recycle + 60, 900)
+
+        self._current_token = None
+        self._token_expires_at = 0.0
+        self._token_rlock = threading.RLock()
+
         self.engine = None
+        self._start_token_refresher()
         self._init_engine()
-        
+
+    def _refresh_token(self):
+        """トークンを同期的に取得し、(トークン, 失効時刻)として保持する
+
+        Authenticatorのキャッシュが同じトークンを返した場合は失効時刻を
+        延長しない（同一トークン＝同一の署名時刻なので寿命も同じ）。
+        """
+        with self._token_rlock:
+            token = self.authenticator.get_auth_token(
+                self.cluster_id, self.token_expires)
+            if token != self._current_token:
+                self._token_expires_at = time.monotonic() + self.token_expires
+            self._current_token = token
+            return token
+
+    def _start_token_refresher(self):
+        """トークンをバックグラウンドで事前署名するデーモンスレッドを開始
+
+        失効の安全マージン直前に起きて再署名しておくことで、do_connectの
+        ホットパスからboto3呼び出し（SigV4署名）を追い出す。
+        """
+        self._refresh_token()
+
+        def _refresher():
+            while True:
+                with self._token_rlock:
+                    expires_at = self._token_expires_at
+                # マージンに入るとAuthenticatorのキャッシュも失効し、
+                # 実際に再署名される。失敗時は5秒後に再試行
+                delay = max(
+                    expires_at - DSQLAuthenticator.TOKEN_SAFETY_MARGIN
+                    - time.monotonic(),
+                    5.0)
+                time.sleep(delay)
+                try:
+                    self._refresh_token()
+                except Exception as e:
+                    logger.warning(f"バックグラウンドのトークン更新に失敗: {e}")
+
+        thread = threading.Thread(target=_refresher, daemon=True,
+                                  name='dsql-token-refresher')
+        thread.start()
+
     def _get_connection_url(self):
         """接続URL生成（トークンは実際の接続時に動的取得）"""
         # パスワードは後で動的に設定するためダミーを使用
@@ -96,48 +182,55 @@ class DSQLSQLAlchemyPool:
             max_overflow=self.max_overflow,
             pool_timeout=self.pool_timeout,
             pool_recycle=self.pool_recycle,
-            pool_pre_ping=True,
+            # pre_pingはチェックアウトごとにSELECT 1の往復を発生させるため無効化。
+            # 代わりにpool_recycleを短めにし、切断時はクエリ層のリトライに任せる
+            pool_pre_ping=False,
             connect_args={
                 'sslmode': 'require'
             },
             echo=False
         )
         
-        # 接続作成時にトークンを動的に取得するイベントハンドラー
+        # 接続作成時にトークンを設定するイベントハンドラー
         @event.listens_for(self.engine, "do_connect")
         def receive_do_connect(dialect, conn_rec, cargs, cparams):
-            # 新しい認証トークンを取得
-            token = self.authenticator.get_auth_token(self.cluster_id, 5)
-            
+            # ホットパスでは事前署名済みトークンを読むだけ。
+            # 未取得または失効間際なら同期的に再生成する
+            # （バックグラウンド更新が失敗していてもここで必ず追いつく）
+            now = time.monotonic()
+            with self._token_rlock:
+                token = self._current_token
+                expires_at = self._token_expires_at
+            if token is None or \
+                    now >= expires_at - DSQLAuthenticator.TOKEN_SAFETY_MARGIN:
+                token = self._refresh_token()
+
             # 接続パラメータを更新
             cparams['password'] = token
             
-            connection_id = f"conn_{id(conn_rec)}"
-            logger.info(f"新しい接続を作成中: {connection_id}")
+            logger.debug("新しい接続を作成中: conn_%s", id(conn_rec))
             
             # psycopg2.connect()を直接呼び出し
             return psycopg2.connect(*cargs, **cparams)
         
         # プールイベントのログ出力
+        # チェックアウト経路はDEBUG＋%s形式（遅延フォーマット）にして
+        # 通常運用時のログコストをゼロに近づける
         @event.listens_for(self.engine.pool, "connect")
         def receive_connect(dbapi_conn, connection_record):
-            connection_id = f"conn_{id(dbapi_conn)}"
-            logger.info(f"プールに接続を追加: {connection_id}")
-        
+            logger.debug("プールに接続を追加: conn_%s", id(dbapi_conn))
+
         @event.listens_for(self.engine.pool, "checkout")
         def receive_checkout(dbapi_conn, connection_record, connection_proxy):
-            connection_id = f"conn_{id(dbapi_conn)}"
-            logger.info(f"プールから接続を取得: {connection_id}")
-        
+            logger.debug("プールから接続を取得: conn_%s", id(dbapi_conn))
+
         @event.listens_for(self.engine.pool, "checkin")
         def receive_checkin(dbapi_conn, connection_record):
-            connection_id = f"conn_{id(dbapi_conn)}"
-            logger.info(f"プールに接続を返却: {connection_id}")
-            
+            logger.debug("プールに接続を返却: conn_%s", id(dbapi_conn))
+
         @event.listens_for(self.engine.pool, "close")
         def receive_close(dbapi_conn, connection_record):
-            connection_id = f"conn_{id(dbapi_conn)}"
-            logger.info(f"接続をクローズ: {connection_id}")
+            logger.debug("接続をクローズ: conn_%s", id(dbapi_conn))
     
     @contextmanager
     def get_connection(self):
@@ -216,9 +309,9 @@ def test_sqlalchemy_pool():
             thread.start()
         
         try:
-            # メインスレッドを維持
-            while True:
-                time.sleep(1)
+            # メインスレッドは停止フラグがセットされるまでOSレベルで待機する
+            # （1秒ごとの起床によるコンテキストスイッチをなくす）
+            stop_flag.wait()
         except KeyboardInterrupt:
             stop_flag.set()
         
@@ -1,8 +1,11 @@
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError
+import functools
 import logging
 import psycopg2
 from psycopg2 import pool
+from psycopg2.extras import execute_batch
 from contextlib import contextmanager
 import time
 from datetime import datetime
@@ -17,34 +20,68 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+@functools.lru_cache(maxsize=None)
+def _get_dsql_client(region):
+    """リージョンごとに1つのboto3 DSQLクライアントをプロセス内で共有する
+
+    boto3クライアントの生成はサービスモデルの読み込み等で高コストなため
+    モジュールレベルでキャッシュする。HTTP接続プールも広めに確保し、
+    並行するトークン取得がソケット待ちにならないようにする。
+    """
+    return boto3.session.Session().client(
+        'dsql',
+        region_name=region,
+        config=Config(
+            retries={'max_attempts': 3, 'mode': 'adaptive'},
+            tcp_keepalive=True,
+            max_pool_connections=50,
+        )
+    )
+
 class DSQLAuthenticator:
+    # トークンを期限切れ直前まで再利用するための安全マージン（秒）
+    TOKEN_SAFETY_MARGIN = 30
+
     def __init__(self, region='us-east-1'):
         self.region = region
-        self.dsql_client = None
-        
+        self._token_cache = {}
+        self._token_lock = threading.Lock()
+
     def _get_dsql_client(self):
-        if self.dsql_client is None:
-            try:
-                self.dsql_client = boto3.client('dsql', region_name=self.region)
-            except Exception as e:
-                logger.error(f"DSQLクライアントの作成に失敗しました: {e}")
-                raise
-        return self.dsql_client
+        try:
+            return _get_dsql_client(self.region)
+        except Exception as e:
+            logger.error(f"DSQLクライアントの作成に失敗しました: {e}")
+            raise
     
     def get_auth_token(self, cluster_identifier, expires):
+        cache_key = (cluster_identifier, expires)
+        with self._token_lock:
+            cached = self._token_cache.get(cache_key)
+            if cached:
+                token, expires_at = cached
+                # 期限切れ間際でなければキャッシュ済みトークンを再利用（SigV4署名を省略）
+                if time.monotonic() < expires_at - self.TOKEN_SAFETY_MARGIN:
+                    logger.debug("キャッシュ済みの認証トークンを再利用します")
+                    return token
+
         try:
             client = self._get_dsql_client()
-            
+
             token = client.generate_db_connect_admin_auth_token(
                 Hostname=cluster_identifier,
                 ExpiresIn=expires
             )
-            
+
             if not token:
                 raise ValueError("認証トークンの取得に失敗しました")
 
+            with self._token_lock:
+                self._token_cache[cache_key] = (token, time.monotonic() + expires)
+
             return token
-            
+
         except NoCredentialsError:
             logger.error("AWS認証情報が設定されていません")
             raise
@@ -62,14 +99,10 @@ class DSQLConnector:
     def connect(self, cluster_identifier, token, database='postgres', username='admin'):
         connection = None
         try:
-            connection = psycopg2.connect(
-                host=cluster_identifier,
-                database=database,
-                user=username,
-                password=token,
-                port=5432,
-                sslmode='require'
-            )
+            # 静的部分を1つのconninfo文字列として渡す
+            conninfo = (f"host={cluster_identifier} dbname={database} "
+                        f"user={username} port=5432 sslmode=require")
+            connection = psycopg2.connect(conninfo, password=token)
             yield connection
             
         except psycopg2.Error as e:
@@ -79,8 +112,22 @@ class DSQLConnector:
             if connection:
                 connection.close()
 
+    def execute_batched(self, connection, query, params_list, page_size=100):
+        """複数の小さなクエリを1回の往復にまとめて実行する
+
+        psycopg2にはlibpqのパイプラインAPIがないため、execute_batchで
+        複数文を連結して送信し、N往復を約1往復に減らす。
+        """
+        with connection.cursor() as cur:
+            execute_batch(cur, query, params_list, page_size=page_size)
+
 class DSQLPoolManager:
-    def __init__(self, authenticator, cluster_id, endpoint, minconn=1, maxconn=20, 
+    # プール状態文字列をキャッシュする秒数
+    STATUS_CACHE_TTL = 1.0
+    # この秒数を超えた接続はpool_recycle相当で作り直す
+    MAX_CONNECTION_AGE = 3600
+
+    def __init__(self, authenticator, cluster_id, endpoint, minconn=1, maxconn=20,
                  database='postgres', username='admin'):
         self.authenticator = authenticator
         self.cluster_id = cluster_id
@@ -91,69 +138,84 @@ class DSQLPoolManager:
         self.username = username
         self.pool = None
         self._lock = threading.Lock()
-        
+        # 静的な接続パラメータは毎回kwargsから組み立てず事前に文字列化しておく
+        self._conninfo = (f"host={endpoint} dbname={database} "
+                          f"user={username} port=5432 sslmode=require")
+        self._status_cache = None
+        self._status_cached_at = 0.0
+        self._status_lock = threading.Lock()
+        # 接続ごとの作成時刻（psycopg2接続は任意属性を持てないためid()で管理）
+        self._conn_created_at = {}
+        # トークンの有効期間は接続の寿命（MAX_CONNECTION_AGE）に合わせる
+        self._token_expires = max(self.MAX_CONNECTION_AGE + 60, 900)
+
         # 初期プール作成
         self._init_pool()
         
     def _init_pool(self):
-        token = self.authenticator.get_auth_token(self.cluster_id, 120)                 
+        token = self.authenticator.get_auth_token(self.cluster_id, self._token_expires)
         try:
             if self.pool:
                 self.pool.closeall()
-                
+
+            # 旧プールの作成時刻が残っていると、id()を再利用した新しい
+            # 接続を寿命超過と誤判定するため必ず破棄する
+            self._conn_created_at.clear()
             self.pool = psycopg2.pool.ThreadedConnectionPool(
                 self.minconn,
                 self.maxconn,
-                host=self.endpoint,
-                database=self.database,
-                user=self.username,
-                password=token,
-                port=5432,
-                sslmode='require'
+                self._conninfo,
+                password=token
             )
             
         except Exception as e:
             raise
     
-    def _create_single_connection(self):
-        token = self.authenticator.get_auth_token(self.cluster_id, 120)
-        
-        connection = psycopg2.connect(
-            host=self.endpoint,
-            database=self.database,
-            user=self.username,
-            password=token,
-            port=5432,
-            sslmode='require'
-        )
-        
-        logger.info("新しい接続の個別作成が完了しました")
-        return connection
-    
     @contextmanager
     def get_db_connection(self):
         connection = None
         try:
             if not self.pool:
                 raise Exception("コネクションプールが初期化されていません")
-                
-            connection = self.pool.getconn()
-            if connection.closed:
-                logger.warning("閉じられた接続を検出、個別で再作成します")
+
+            # SELECT 1のプローブは行わない。クローズ済み・寿命超過の判定は
+            # ローカルで済ませ、本当に死んでいる接続は最初のクエリの
+            # OperationalError/InterfaceErrorで検出して破棄する。
+            # プール内の全接続が寿命超過している可能性もあるため、
+            # 健全な接続が出てくるまで（最大maxconn回）取り直す
+            for _ in range(self.maxconn + 1):
+                connection = self.pool.getconn()
+                created_at = self._conn_created_at.get(id(connection))
+                expired = created_at is not None and \
+                    time.monotonic() - created_at > self.MAX_CONNECTION_AGE
+                if not connection.closed and not expired:
+                    break
+                logger.warning("閉じられた／寿命超過の接続を検出、プール経由で再作成します")
+                self._conn_created_at.pop(id(connection), None)
+                # ThreadedConnectionPoolは_init_pool時のパスワードで
+                # 再接続するため、破棄のたびに新しいトークンを
+                # 接続パラメータへ反映しておく（トークンキャッシュが
+                # 有効なうちはboto3呼び出しは発生しない）
+                self.pool._kwargs['password'] = self.authenticator.get_auth_token(
+                    self.cluster_id, self._token_expires)
+                # プール会計を保つため、個別作成ではなくプールから取り直す
                 self.pool.putconn(connection, close=True)
-                connection = self._create_single_connection()
-                
+                connection = None
+            if connection is None:
+                raise Exception("健全な接続を取得できませんでした")
+
+            if id(connection) not in self._conn_created_at:
+                self._conn_created_at[id(connection)] = time.monotonic()
+
             try:
-                with connection.cursor() as cur:
-                    cur.execute("SELECT 1")
-                    cur.fetchone()
-            except Exception as e:
-                logger.warning(f"接続健全性チェック失敗: {e}")
+                yield connection
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # 利用中に死んだ接続はプールに返さず破棄する
+                self._conn_created_at.pop(id(connection), None)
                 self.pool.putconn(connection, close=True)
-                connection = self._create_single_connection()
-                
-            yield connection
-            
+                connection = None
+                raise
+
         except Exception as e:
             logger.error(f"接続取得エラー: {e}")
             raise
@@ -168,19 +230,29 @@ class DSQLPoolManager:
     def get_pool_status(self):
         if not self.pool:
             return "プールなし"
-        try:
-            # ThreadedConnectionPoolの内部状態を取得
-            total_connections = len(self.pool._pool) + len(self.pool._used)
-            available_connections = len(self.pool._pool)
-            used_connections = len(self.pool._used)
-            return f"総接続数:{total_connections}, 利用可能:{available_connections}, 使用中:{used_connections}"
-        except Exception as e:
-            return f"プール状態取得エラー: {e}"
+        # プール内部ロックと競合しないよう、TTL内はキャッシュ済み文字列を返す
+        now = time.monotonic()
+        with self._status_lock:
+            if self._status_cache is not None and \
+                    now - self._status_cached_at < self.STATUS_CACHE_TTL:
+                return self._status_cache
+            try:
+                # ThreadedConnectionPoolの内部状態を取得
+                total_connections = len(self.pool._pool) + len(self.pool._used)
+                available_connections = len(self.pool._pool)
+                used_connections = len(self.pool._used)
+                status = f"総接続数:{total_connections}, 利用可能:{available_connections}, 使用中:{used_connections}"
+            except Exception as e:
+                return f"プール状態取得エラー: {e}"
+            self._status_cache = status
+            self._status_cached_at = now
+            return status
     
     def close_all(self):
         if self.pool:
             self.pool.closeall()
             self.pool = None
+        self._conn_created_at.clear()
 
 def test_connection_pool():
     CLUSTER_ID = "g4abult6r6rrzachxrubfgunia"
@@ -204,7 +276,19 @@ def test_connection_pool():
                 try:
                     with pool_manager.get_db_connection() as conn:
                         with conn.cursor() as cur:
-                            cur.execute("SELECT CURRENT_TIMESTAMP, 'thread_' || %s;", (thread_id,))
+                            # PREPARE済みかどうかはクライアント側で追跡しない
+                            # （id()は再利用されうる）。未PREPAREの接続は
+                            # EXECUTEがInvalidSqlStatementNameで教えてくれる
+                            # ので、その場でPREPAREし直す
+                            try:
+                                cur.execute("EXECUTE worker_stmt(%s);", (thread_id,))
+                            except psycopg2.errors.InvalidSqlStatementName:
+                                # エラーで中断したトランザクションを巻き戻してから
+                                conn.rollback()
+                                cur.execute(
+                                    "PREPARE worker_stmt(int) AS "
+                                    "SELECT CURRENT_TIMESTAMP, 'thread_' || $1;")
+                                cur.execute("EXECUTE worker_stmt(%s);", (thread_id,))
                             result = cur.fetchone()
                             timestamp, thread_msg = result
                             logger.info(f"✓ スレッド{thread_id}: {thread_msg} at {timestamp}")
@@ -225,9 +309,9 @@ def test_connection_pool():
             thread.start()
                 
         try:
-            # メインスレッドを維持
-            while True:
-                time.sleep(1)
+            # メインスレッドは停止フラグがセットされるまでOSレベルで待機する
+            # （1秒ごとの起床によるコンテキストスイッチをなくす）
+            stop_flag.wait()
         except KeyboardInterrupt:
             stop_flag.set()
                     
@@ -0,0 +1,188 @@
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, NoCredentialsError
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg_pool import ConnectionPool
+
+# ログ設定
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s.%(msecs)03d - %(thread)d - %(threadName)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_dsql_client(region):
+    """リージョンごとに1つのboto3 DSQLクライアントをプロセス内で共有する
+
+    boto3クライアントの生成はサービスモデルの読み込み等で高コストなため
+    モジュールレベルでキャッシュする。HTTP接続プールも広めに確保し、
+    並行するトークン取得がソケット待ちにならないようにする。
+    """
+    return boto3.session.Session().client(
+        'dsql',
+        region_name=region,
+        config=Config(
+            retries={'max_attempts': 3, 'mode': 'adaptive'},
+            tcp_keepalive=True,
+            max_pool_connections=50,
+        )
+    )
+
+class DSQLAuthenticator:
+    # トークンを期限切れ直前まで再利用するための安全マージン（秒）
+    TOKEN_SAFETY_MARGIN = 30
+
+    def __init__(self, region='us-east-1'):
+        self.region = region
+        self._token_cache = {}
+        self._token_lock = threading.Lock()
+
+    def _get_dsql_client(self):
+        try:
+            return _get_dsql_client(self.region)
+        except Exception as e:
+            logger.error(f"DSQLクライアントの作成に失敗しました: {e}")
+            raise
+
+    def get_auth_token(self, cluster_identifier, expires):
+        cache_key = (cluster_identifier, expires)
+        with self._token_lock:
+            cached = self._token_cache.get(cache_key)
+            if cached:
+                token, expires_at = cached
+                # 期限切れ間際でなければキャッシュ済みトークンを再利用（SigV4署名を省略）
+                if time.monotonic() < expires_at - self.TOKEN_SAFETY_MARGIN:
+                    logger.debug("キャッシュ済みの認証トークンを再利用します")
+                    return token
+
+        try:
+            client = self._get_dsql_client()
+
+            token = client.generate_db_connect_admin_auth_token(
+                Hostname=cluster_identifier,
+                ExpiresIn=expires
+            )
+
+            if not token:
+                raise ValueError("認証トークンの取得に失敗しました")
+
+            with self._token_lock:
+                self._token_cache[cache_key] = (token, time.monotonic() + expires)
+
+            return token
+
+        except NoCredentialsError:
+            logger.error("AWS認証情報が設定されていません")
+            raise
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            error_message = e.response['Error']['Message']
+            logger.error(f"AWS API エラー: {error_code} - {error_message}")
+            raise
+        except Exception as e:
+            logger.error(f"予期しないエラーが発生しました: {e}")
+            raise
+
+class DSQLConnectionPool(ConnectionPool):
+    """psycopg_pool.ConnectionPoolにIAMトークン注入を追加したDSQL用プール
+
+    ヘルスチェック・rollback・再接続（バックオフ付き）はpsycopg_pool側の
+    実装に任せる。接続作成時のパスワードだけDSQLAuthenticatorの
+    キャッシュ済みトークンで差し替える。
+    """
+
+    def __init__(self, authenticator, cluster_id, conninfo, kwargs=None, **pool_kwargs):
+        self._authenticator = authenticator
+        self._cluster_id = cluster_id
+        # 利用側から渡された固定の接続kwargsにトークンを重ねる
+        self._base_kwargs = dict(kwargs or {})
+        # psycopg_pool 3.3のcallable kwargsフック：接続作成のたびに
+        # 評価されるので、私有の_connectを上書きせずに済む
+        super().__init__(conninfo, kwargs=self._connect_kwargs, **pool_kwargs)
+
+    def _connect_kwargs(self):
+        # トークンはDSQLAuthenticator側でキャッシュされるため、
+        # キャッシュヒット時はここでboto3呼び出しは発生しない
+        connect_kwargs = dict(self._base_kwargs)
+        connect_kwargs['password'] = self._authenticator.get_auth_token(
+            self._cluster_id, 900)
+        return connect_kwargs
+
+    @contextmanager
+    def pipelined_connection(self, timeout=None):
+        """パイプラインモードの接続を貸し出すコンテキストマネージャー
+
+        複数の小さなSELECTをまとめて発行する呼び出し側はこちらを使うと、
+        各文の結果を待たずに送信でき、N往復が1往復になる。
+        """
+        with self.connection(timeout=timeout) as conn:
+            with conn.pipeline():
+                yield conn
+
+
+def test_connection_pool():
+    CLUSTER_ID = "g4abult6r6rrzachxrubfgunia"
+    ENDPOINT = "g4abult6r6rrzachxrubfgunia.dsql.ap-northeast-1.on.aws"
+
+    try:
+        authenticator = DSQLAuthenticator(region='ap-northeast-1')
+        conninfo = f"host={ENDPOINT} dbname=postgres user=admin port=5432 sslmode=require"
+        pool = DSQLConnectionPool(
+            authenticator,
+            CLUSTER_ID,
+            conninfo,
+            min_size=3,
+            max_size=5,
+            # checkはチェックアウト時に必要な場合のみプール側で実行される
+            check=ConnectionPool.check_connection,
+        )
+
+        # 停止フラグ
+        stop_flag = threading.Event()
+
+        def worker_thread(thread_id):
+            while not stop_flag.is_set():
+                try:
+                    with pool.connection() as conn:
+                        result = conn.execute(
+                            "SELECT CURRENT_TIMESTAMP, 'thread_' || %s;", (thread_id,))
+                        timestamp, thread_msg = result.fetchone()
+                        logger.info(f"✓ スレッド{thread_id}: {thread_msg} at {timestamp}")
+                except Exception as e:
+                    logger.error(f"✗ スレッド{thread_id} エラー: {e}")
+                finally:
+                    # プール状態をログに出力
+                    logger.info(f"プール状態 (スレッド{thread_id}): {pool.get_stats()}")
+
+                time.sleep(120)
+
+        threads = []
+        for i in range(3):
+            thread = threading.Thread(target=worker_thread, args=(i+1,))
+            thread.daemon = True
+            threads.append(thread)
+            thread.start()
+
+        try:
+            # メインスレッドは停止フラグがセットされるまでOSレベルで待機する
+            # （1秒ごとの起床によるコンテキストスイッチをなくす）
+            stop_flag.wait()
+        except KeyboardInterrupt:
+            stop_flag.set()
+
+        # プールのクリーンアップ
+        pool.close()
+
+    except Exception as e:
+        logger.error(f"テストエラー: {e}")
+
+if __name__ == "__main__":
+    test_connection_pool()
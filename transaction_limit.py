@@ -91,9 +91,19 @@ def main():
                 conn.autocommit = False
                 with conn.cursor() as cur:
                     logger.info(f"✓ 開始")
-                    cur.execute("BEGIN;")
-                    cur.execute("SELECT pg_sleep(600);")
-                    cur.execute("COMMIT;")
+                    # autocommit=Falseでは最初のexecuteで暗黙のBEGINが発行される
+                    # ため、明示的なBEGIN;/COMMIT;文は送らない（往復2回の節約と
+                    # "there is already a transaction in progress" NOTICEの回避）。
+                    # また、DSQLは5分のトランザクション制限があるため、
+                    # サーバ側のpg_sleep(600)ではなくトランザクション外の
+                    # クライアント側sleepで待機し、各トランザクションは短く保つ
+                    cur.execute("SELECT 1;")
+                    cur.fetchone()
+                    conn.commit()
+                    time.sleep(600)
+                    cur.execute("SELECT 1;")
+                    cur.fetchone()
+                    conn.commit()
                     logger.info(f"✓ 終了")
         except Exception as e:
             logger.error(f"✗ DB接続エラー: {e}")